@@ -3,5 +3,6 @@
 """
 
 from .dataset import Dataset, Video, Document, Page, Frame, Coordinate, BoundingQuadrilinear, \
-        Screen, KeyRef, FOLDS_NUM, RANDOM_STATE
+        Screen, KeyRef, CONDITIONS, FOLDS_NUM, RANDOM_STATE, OUTLIER_WINDOWED, \
+        OUTLIER_OBSTACLE, OUTLIER_BEYOND_BOUNDS, OUTLIER_INCREMENTAL, OUTLIER_NO_MATCH
 from .review import crop
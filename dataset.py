@@ -5,16 +5,64 @@ from collections import namedtuple
 import json
 import logging
 import random
+import sys
 
 from lxml import etree
 from lxml.etree import XML, XMLSchema, XMLParser
-from numpy import array
+import numpy as np
 
 DATASET_FILENAME = "dataset.xml"
 SCHEMA_FILENAME = "schema.xsd"
 LOGGER = logging.getLogger(__name__)
 FOLDS_NUM = 17
 RANDOM_STATE = 12345
+CONDITIONS = ("pristine", "windowed", "obstacle")
+_CONDITION_CODES = {condition: code for code, condition in enumerate(CONDITIONS)}
+
+# These XPath expressions follow the structure of the dataset, as given by the schema.
+_XPATH_VIDEOS = etree.XPath("./video")
+_XPATH_DOCUMENTS = etree.XPath("./documents/document")
+_XPATH_PAGES = etree.XPath("./page")
+_XPATH_FRAMES = etree.XPath("./frames/frame")
+_XPATH_SCREENS = etree.XPath("./screens/screen")
+_XPATH_KEYREFS = etree.XPath("./keyrefs/keyref")
+_XPATH_PAGES_NUM = etree.XPath("count(./video/documents/document/page)")
+_XPATH_FRAMES_NUM = etree.XPath("count(./video/frames/frame)")
+_XPATH_SCREENS_NUM = etree.XPath("count(./video/frames/frame/screens/screen)")
+_XPATH_VIDEO_VGG256 = (
+    etree.XPath("./documents/document/page/@vgg256"),
+    etree.XPath("./frames/frame/@vgg256"),
+    etree.XPath("./frames/frame/screens/screen/@vgg256"))
+_SCREEN_COORDINATES = ("x0", "y0", "x1", "y1", "x2", "y2", "x3", "y3")
+
+# These bits characterize the ways in which a screen can be an outlier (see Screen.is_outlier).
+OUTLIER_WINDOWED = 1 << 0
+OUTLIER_OBSTACLE = 1 << 1
+OUTLIER_BEYOND_BOUNDS = 1 << 2
+OUTLIER_INCREMENTAL = 1 << 3
+OUTLIER_NO_MATCH = 1 << 4
+
+def _outlier_mask(windowed, obstacle, beyond_bounds, incremental, no_match):
+    """ Combines the outlier bits selected by the parameters of Screen.is_outlier. """
+    return (OUTLIER_WINDOWED if windowed else 0) \
+        | (OUTLIER_OBSTACLE if obstacle else 0) \
+        | (OUTLIER_BEYOND_BOUNDS if beyond_bounds else 0) \
+        | (OUTLIER_INCREMENTAL if incremental else 0) \
+        | (OUTLIER_NO_MATCH if no_match else 0)
+
+def _parse_vgg256(attributes, matrix):
+    """Decodes JSON-encoded vgg256 attributes into the rows of a float32 matrix. The attributes are
+    parsed by NumPy directly, without materializing lists of Python floats. The shape of a row is
+    taken from the first feature vector in the dataset; an attribute with a different number of
+    values is rejected with a ValueError, so datasets that mix feature vector shapes do not load.
+
+    Parameters:
+        attributes  The values of the vgg256 attributes.
+        matrix      The matrix that will receive the decoded feature vectors, a row per attribute.
+    """
+    for attribute, row in zip(attributes, matrix):
+        numbers = attribute.replace("[", "").replace("]", "")
+        row[...] = np.fromstring(numbers, dtype=np.float32, sep=",").reshape(row.shape)
 
 class Dataset(object):
     """ This class represents the entire dataset. """
@@ -28,12 +76,12 @@ class Dataset(object):
         self.filename = "%s/%s" % (self.dirname, DATASET_FILENAME)
 
         LOGGER.info("Validating the dataset ...")
-        tree = etree.parse(self.filename)
+        tree = etree.parse(self.filename, XMLParser(huge_tree=True))
         tree.xinclude()
         with open("%s/%s" % (self.dirname, SCHEMA_FILENAME), "rb") as f:
             schema = XMLSchema(file=f)
-        xmlparser = XMLParser(schema=schema, huge_tree=True)
-        element = etree.fromstring(etree.tostring(tree), xmlparser)
+        schema.assertValid(tree)
+        element = tree.getroot()
         LOGGER.info("Done validating the dataset.")
 
         LOGGER.info("Processing the dataset ...")
@@ -43,21 +91,70 @@ class Dataset(object):
         self.frames = []
         self.screens = []
         self.keyrefs = []
-        for descendant in element.findall(".//video"):
-            video = Video(self, descendant)
-            self.videos.append(video)
-            self.documents.extend(video.documents)
-            self.pages.extend(video.pages)
-            self.frames.extend(video.frames)
-            self.screens.extend(video.screens)
-            self.keyrefs.extend(video.keyrefs)
+
+        # Page keys are unique within a video, so pages are looked up by (Video.dirname, Page.key).
+        self.pages_by_key = {}
+
+        # The feature vectors of pages, frames, and screens are stored in contiguous float32
+        # matrices indexed by Page.index, Frame.index, and Screen.index, respectively. The feature
+        # vectors are decoded one video at a time straight into the matrices.
+        videos = _XPATH_VIDEOS(element)
+        pages_num = int(_XPATH_PAGES_NUM(element))
+        frames_num = int(_XPATH_FRAMES_NUM(element))
+        screens_num = int(_XPATH_SCREENS_NUM(element))
+        first_vgg256 = next(element.iter("page", "frame", "screen"), None)
+        vgg256_shape = np.shape(json.loads(first_vgg256.get("vgg256"))) \
+            if first_vgg256 is not None else ()
+        self.page_vgg256 = np.empty((pages_num,) + vgg256_shape, dtype=np.float32)
+        self.frame_vgg256 = np.empty((frames_num,) + vgg256_shape, dtype=np.float32)
+        self.screen_vgg256 = np.empty((screens_num,) + vgg256_shape, dtype=np.float32)
+        matrices = (self.page_vgg256, self.frame_vgg256, self.screen_vgg256)
+        offsets = [0] * len(matrices)
+        for video in videos:
+            for kind, (xpath, matrix) in enumerate(zip(_XPATH_VIDEO_VGG256, matrices)):
+                attributes = xpath(video)
+                start, offsets[kind] = offsets[kind], offsets[kind] + len(attributes)
+                _parse_vgg256(attributes, matrix[start:offsets[kind]])
+
+        # Screen attributes are also stored in parallel columns indexed by Screen.index:
+        # screen_condition holds indices into CONDITIONS, screen_bounds holds the coordinates
+        # x0, y0, ..., x3, y3, screen_flags holds the OUTLIER_* bits of Screen.flags, and
+        # frame_of_screen holds indices into self.frames.
+        self.screen_condition = np.empty(screens_num, dtype=np.int8)
+        self.screen_bounds = np.empty((screens_num, 8), dtype=np.int64)
+        self.screen_flags = np.empty(screens_num, dtype=np.uint8)
+        self.frame_of_screen = np.empty(screens_num, dtype=np.int32)
+
+        # The constructed objects register themselves with the dataset and fill in the columns.
+        for descendant in videos:
+            Video(self, descendant)
+
+        # The screens that go beyond the bounds of their videos are detected in bulk.
+        video_sizes = np.array([(video.width, video.height) for video in self.videos],
+                               dtype=np.int64).reshape(-1, 2)
+        screens_per_video = [len(video.screens) for video in self.videos]
+        width, height = np.repeat(video_sizes, screens_per_video, axis=0).T
+        bounds = self.screen_bounds
+        is_beyond_bounds = (bounds[:, [0, 4]] < 0).any(axis=1) \
+                | (bounds[:, [2, 6]] >= width[:, np.newaxis]).any(axis=1) \
+                | (bounds[:, [1, 3]] < 0).any(axis=1) \
+                | (bounds[:, [5, 7]] >= height[:, np.newaxis]).any(axis=1)
+        self.screen_flags[is_beyond_bounds] |= OUTLIER_BEYOND_BOUNDS
         LOGGER.info("Done processing the dataset, which contains:")
         LOGGER.info("- %d videos containing %d frames with %d screens (%d non-matched)" + \
                     " and %d keyrefs, and", len(self.videos), len(self.frames), len(self.screens), \
-                    len([screen for screen in self.screens if not screen.matching_pages]), \
-                    len(self.keyrefs))
+                    np.count_nonzero(self.screen_flags & OUTLIER_NO_MATCH), len(self.keyrefs))
         LOGGER.info("- %d documents containing %d pages.", len(self.documents), len(self.pages))
 
+    def screen_outliers(self, windowed=True, obstacle=True, beyond_bounds=True, incremental=True,
+                        no_match=True):
+        """Returns a boolean array that specifies which screens in self.screens are outliers.
+
+        The parameters have the same meaning as the parameters of Screen.is_outlier.
+        """
+        mask = _outlier_mask(windowed, obstacle, beyond_bounds, incremental, no_match)
+        return (self.screen_flags & mask) != 0
+
     def task1_evaluation_dataset(self, k_folds=FOLDS_NUM, random_state=RANDOM_STATE):
         """Produces an evaluation dataset for task1, subtask A (screen-based document page
         retrieval) and subtask B (no-match screen detection). The method returns a list of videos
@@ -72,13 +169,16 @@ class Dataset(object):
         sample = self.videos[:]
         random.seed(random_state)
         random.shuffle(sample)
-        return array(sample[:len(sample)-len(sample)%k_folds])
+        return np.array(sample[:len(sample)-len(sample)%k_folds])
 
     def __repr__(self):
         return "Dataset %s" % self.filename
 
 class Video(object):
     """ This class represents a single video. """
+    __slots__ = ("dataset", "dirname", "fps", "frames_num", "width", "height", "uri", "documents",
+                 "pages", "frames", "screens", "keyrefs")
+
     def __init__(self, dataset, element):
         """Constructs the object representation of a single video.
 
@@ -87,32 +187,30 @@ class Video(object):
             element The XML element that represents the video.
         """
         self.dataset = dataset
+        dataset.videos.append(self)
 
         # Set own attributes.
-        self.dirname = "%s/%s" % (dataset.dirname, element.attrib["dirname"])
-        self.fps = int(element.attrib["fps"])
-        self.frames_num = int(element.attrib["frames"])
-        self.width = int(element.attrib["width"])
-        self.height = int(element.attrib["height"])
-        self.uri = element.attrib["uri"]
+        self.dirname = "%s/%s" % (dataset.dirname, element.get("dirname"))
+        self.fps = int(element.get("fps"))
+        self.frames_num = int(element.get("frames"))
+        self.width = int(element.get("width"))
+        self.height = int(element.get("height"))
+        self.uri = element.get("uri")
         self.documents = []
 
         # Process descendant elements.
         ## Process documents.
-        for document in element.findall(".//document"):
+        for document in _XPATH_DOCUMENTS(element):
             self.documents.append(Document(dataset, self, document))
         self.pages = []
-        self.page_dict = {}
         for document in self.documents:
             self.pages.extend(document.pages)
-            for page in document.pages:
-                self.page_dict[page.key] = page
 
         ## Process frames.
         self.frames = []
         self.screens = []
         self.keyrefs = []
-        for descendant in element.findall(".//frame"):
+        for descendant in _XPATH_FRAMES(element):
             frame = Frame(dataset, self, descendant)
             self.frames.append(frame)
             self.screens.extend(frame.screens)
@@ -129,6 +227,8 @@ class Video(object):
 
 class Document(object):
     """ This class represents a document. """
+    __slots__ = ("video", "filename", "pages")
+
     def __init__(self, dataset, parent, element):
         """Constructs the object representation of a document.
 
@@ -137,18 +237,23 @@ class Document(object):
             parent  The parent Video object.
             element The XML element that represents the document.
         """
-        self.dataset = dataset
         self.video = parent
+        dataset.documents.append(self)
 
         # Set own attributes.
-        self.filename = "%s/%s" % (parent.dirname, element.attrib["filename"])
+        self.filename = "%s/%s" % (parent.dirname, element.get("filename"))
 
         # Process descendant elements.
         self.pages = []
-        for descendant in element.findall(".//page"):
+        for descendant in _XPATH_PAGES(element):
             page = Page(dataset, self, descendant)
             self.pages.append(page)
 
+    @property
+    def dataset(self):
+        """ The dataset to which the document belongs. """
+        return self.video.dataset
+
     def __repr__(self):
         return "Document %s" % self.filename
 
@@ -160,6 +265,8 @@ class Document(object):
 
 class Page(object):
     """ This class represents a page in a document. """
+    __slots__ = ("document", "index", "filename", "key", "number", "vgg256")
+
     def __init__(self, dataset, parent, element):
         """Constructs the object representation of a page in a document.
 
@@ -168,15 +275,26 @@ class Page(object):
             parent  The parent Document object.
             element The XML element that represents the page.
         """
-        self.dataset = dataset
         self.document = parent
-        self.video = self.document.video
+        self.index = len(dataset.pages)
+        dataset.pages.append(self)
 
         # Set own attributes.
-        self.filename = "%s/%s" % (self.video.dirname, element.attrib["filename"])
-        self.key = element.attrib["key"]
-        self.number = int(element.attrib["number"])
-        self.vgg256 = json.loads(element.attrib["vgg256"])
+        self.filename = "%s/%s" % (self.video.dirname, element.get("filename"))
+        self.key = element.get("key")
+        dataset.pages_by_key[(self.video.dirname, self.key)] = self
+        self.number = int(element.get("number"))
+        self.vgg256 = dataset.page_vgg256[self.index]
+
+    @property
+    def video(self):
+        """ The video to which the page belongs. """
+        return self.document.video
+
+    @property
+    def dataset(self):
+        """ The dataset to which the page belongs. """
+        return self.document.video.dataset
 
     def __repr__(self):
         return "Page %s" % self.filename
@@ -189,6 +307,8 @@ class Page(object):
 
 class Frame(object):
     """ This class represents a video frame. """
+    __slots__ = ("video", "index", "filename", "number", "vgg256", "screens", "keyrefs")
+
     def __init__(self, dataset, parent, element):
         """Constructs the object representation of a video frame.
 
@@ -197,22 +317,28 @@ class Frame(object):
             parent  The parent Video object.
             element The XML element that represents the video frame.
         """
-        self.dataset = dataset
         self.video = parent
+        self.index = len(dataset.frames)
+        dataset.frames.append(self)
 
         # Set own attributes.
-        self.filename = "%s/%s" % (self.video.dirname, element.attrib["filename"])
-        self.number = int(element.attrib["number"])
-        self.vgg256 = json.loads(element.attrib["vgg256"])
+        self.filename = "%s/%s" % (self.video.dirname, element.get("filename"))
+        self.number = int(element.get("number"))
+        self.vgg256 = dataset.frame_vgg256[self.index]
 
         # Process descendant elements.
         self.screens = []
         self.keyrefs = []
-        for number, descendant in enumerate(element.findall(".//screen")):
+        for number, descendant in enumerate(_XPATH_SCREENS(element)):
             screen = Screen(dataset, self, descendant, number)
             self.screens.append(screen)
             self.keyrefs.extend(screen.keyrefs)
 
+    @property
+    def dataset(self):
+        """ The dataset to which the video frame belongs. """
+        return self.video.dataset
+
     def __repr__(self):
         return "Frame %s" % self.filename
 
@@ -230,7 +356,13 @@ BoundingQuadrilinear = namedtuple("BoundingQuadrilinear",
                                   ["top_left", "top_right", "bottom_left", "bottom_right"])
 
 class Screen(object):
-    """ This class represents a screen on a video frame. """
+    """
+        This class represents a screen on a video frame. The condition, bounds, and outlier flags
+        of the screen are views of the screen_condition, screen_bounds, and screen_flags columns of
+        the dataset.
+    """
+    __slots__ = ("frame", "index", "number", "vgg256", "keyrefs", "matching_pages")
+
     def __init__(self, dataset, parent, element, number):
         """Constructs the object representation of a screen on a video frame.
 
@@ -240,39 +372,78 @@ class Screen(object):
             element The XML element that represents the screen.
             number  The screen number.
         """
-        self.dataset = dataset
         self.frame = parent
-        self.video = self.frame.video
+        self.index = len(dataset.screens)
+        dataset.screens.append(self)
 
         # Set own attributes.
         self.number = number
-        self.condition = element.attrib["condition"]
-        self.vgg256 = json.loads(element.attrib["vgg256"])
-        top_left = Coordinate(int(element.attrib["x0"]), int(element.attrib["y0"]))
-        top_right = Coordinate(int(element.attrib["x1"]), int(element.attrib["y1"]))
-        bottom_left = Coordinate(int(element.attrib["x2"]), int(element.attrib["y2"]))
-        bottom_right = Coordinate(int(element.attrib["x3"]), int(element.attrib["y3"]))
-        self.bounds = BoundingQuadrilinear(top_left, top_right, bottom_left, bottom_right)
-        self.is_beyond_bounds = self.bounds.top_left.x < 0 \
-                or self.bounds.bottom_left.x < 0 \
-                or self.bounds.top_right.x >= self.video.width \
-                or self.bounds.bottom_right.x >= self.video.width \
-                or self.bounds.top_left.y < 0 \
-                or self.bounds.top_right.y < 0 \
-                or self.bounds.bottom_left.y >= self.video.height \
-                or self.bounds.bottom_right.y >= self.video.height
+        self.vgg256 = dataset.screen_vgg256[self.index]
+        condition = element.get("condition")
+        dataset.screen_bounds[self.index] = [int(element.get(name)) for name in _SCREEN_COORDINATES]
 
         # Process descendant elements.
         self.keyrefs = []
-        for descendant in element.findall(".//keyref"):
+        matching_pages = []
+        fully_matching_pages = []
+        for descendant in _XPATH_KEYREFS(element):
             keyref = KeyRef(self, dataset, descendant)
             self.keyrefs.append(keyref)
-        self.matching_pages = [keyref.page for keyref in self.keyrefs \
-                               if keyref.similarity == "full"]
-        if not self.matching_pages: # If there is no fully matching page, accept any matching page.
-            self.matching_pages = [keyref.page for keyref in self.keyrefs]
+            matching_pages.append(keyref.page)
+            if keyref.similarity == "full":
+                fully_matching_pages.append(keyref.page)
+        # If there is no fully matching page, accept any matching page.
+        self.matching_pages = fully_matching_pages or matching_pages
         assert len(set(self.matching_pages)) == len(self.matching_pages)
 
+        # Precompute the outlier bits. The beyond-bounds bit is set later by the dataset.
+        flags = 0
+        if condition == "windowed":
+            flags |= OUTLIER_WINDOWED
+        if condition == "obstacle":
+            flags |= OUTLIER_OBSTACLE
+        if self.keyrefs and not fully_matching_pages:
+            flags |= OUTLIER_INCREMENTAL
+        if not self.keyrefs:
+            flags |= OUTLIER_NO_MATCH
+
+        # Fill in the columns of the dataset.
+        dataset.screen_condition[self.index] = _CONDITION_CODES[condition]
+        dataset.screen_flags[self.index] = flags
+        dataset.frame_of_screen[self.index] = self.frame.index
+
+    @property
+    def video(self):
+        """ The video to which the screen belongs. """
+        return self.frame.video
+
+    @property
+    def dataset(self):
+        """ The dataset to which the screen belongs. """
+        return self.frame.video.dataset
+
+    @property
+    def condition(self):
+        """ The condition of what is shown on the screen, one of CONDITIONS. """
+        return CONDITIONS[self.dataset.screen_condition[self.index]]
+
+    @property
+    def bounds(self):
+        """ The BoundingQuadrilinear of the screen. """
+        x0, y0, x1, y1, x2, y2, x3, y3 = self.dataset.screen_bounds[self.index].tolist()
+        return BoundingQuadrilinear(Coordinate(x0, y0), Coordinate(x1, y1), Coordinate(x2, y2),
+                                    Coordinate(x3, y3))
+
+    @property
+    def flags(self):
+        """ The OUTLIER_* bits of the screen. """
+        return int(self.dataset.screen_flags[self.index])
+
+    @property
+    def is_beyond_bounds(self):
+        """ Whether the screen goes beyond the bounds of the video. """
+        return bool(self.flags & OUTLIER_BEYOND_BOUNDS)
+
     def is_outlier(self, windowed=True, obstacle=True, beyond_bounds=True, incremental=True,
                    no_match=True):
         """
@@ -292,18 +463,8 @@ class Screen(object):
 
             The above parameters fully characterize an outlier.
         """
-        if windowed and self.condition == "windowed":
-            return True
-        if obstacle and self.condition == "obstacle":
-            return True
-        if beyond_bounds and self.is_beyond_bounds:
-            return True
-        if incremental and self.keyrefs \
-                and not [keyref for keyref in self.keyrefs if keyref.similarity == "full"]:
-            return True
-        if no_match and not self.keyrefs:
-            return True
-        return False
+        mask = _outlier_mask(windowed, obstacle, beyond_bounds, incremental, no_match)
+        return bool(self.flags & mask)
 
     def __repr__(self):
         return "%s, screen #%d" % (self.frame, self.number + 1)
@@ -320,6 +481,8 @@ class KeyRef(object):
         This class represents a is-displayed-on relation between a document page and a screen on a
         video frame.
     """
+    __slots__ = ("screen", "page", "similarity")
+
     def __init__(self, parent, dataset, element):
         """Constructs the object representation of a relation between a document page and a screen.
 
@@ -328,12 +491,22 @@ class KeyRef(object):
             parent  The parent Screen object.
             element The XML element that represents the relation.
         """
-        self.dataset = dataset
-        self.video = parent.video
-        self.page = self.video.page_dict[element.text]
+        self.screen = parent
+        self.page = dataset.pages_by_key[(parent.video.dirname, element.text)]
+        dataset.keyrefs.append(self)
 
         # Set own attributes.
-        self.similarity = element.attrib["similarity"]
+        self.similarity = sys.intern(element.get("similarity"))
+
+    @property
+    def video(self):
+        """ The video to which the relation belongs. """
+        return self.screen.frame.video
+
+    @property
+    def dataset(self):
+        """ The dataset to which the relation belongs. """
+        return self.screen.frame.video.dataset
 
     def __repr__(self):
         return "KeyRef: %s <-> %s" % (self.video, self.page)
@@ -2,21 +2,27 @@
     Displays the individual frames of the annotated videos along with screens
     and the associated document pages.
 """
+from functools import lru_cache
+import math
+
 import cv2
 import numpy as np
 
 from dataset import Dataset
 
-def crop(image, quadrilinear):
-    """ Crops out a quadrilinear out of the input image. """
-    width_a = np.sqrt(((quadrilinear.bottom_right.x - quadrilinear.bottom_left.x) ** 2)
-                      + ((quadrilinear.bottom_right.y - quadrilinear.bottom_left.y) ** 2))
-    width_b = np.sqrt(((quadrilinear.top_right.x - quadrilinear.top_left.x) ** 2)
-                      + ((quadrilinear.top_right.y - quadrilinear.top_left.y) ** 2))
-    height_a = np.sqrt(((quadrilinear.top_right.x - quadrilinear.bottom_right.x) ** 2)
-                       + ((quadrilinear.top_right.y - quadrilinear.bottom_right.y) ** 2))
-    height_b = np.sqrt(((quadrilinear.top_left.x - quadrilinear.bottom_left.x) ** 2)
-                       + ((quadrilinear.top_left.y - quadrilinear.bottom_left.y) ** 2))
+def _crop_geometry(quadrilinear):
+    """
+        Computes the dimensions of the image cropped out of a quadrilinear along with the source
+        and destination points of the perspective transform.
+    """
+    width_a = math.hypot(quadrilinear.bottom_right.x - quadrilinear.bottom_left.x,
+                         quadrilinear.bottom_right.y - quadrilinear.bottom_left.y)
+    width_b = math.hypot(quadrilinear.top_right.x - quadrilinear.top_left.x,
+                         quadrilinear.top_right.y - quadrilinear.top_left.y)
+    height_a = math.hypot(quadrilinear.top_right.x - quadrilinear.bottom_right.x,
+                          quadrilinear.top_right.y - quadrilinear.bottom_right.y)
+    height_b = math.hypot(quadrilinear.top_left.x - quadrilinear.bottom_left.x,
+                          quadrilinear.top_left.y - quadrilinear.bottom_left.y)
     max_width = max(int(width_a), int(width_b))
     max_height = max(int(height_a), int(height_b))
 
@@ -26,10 +32,24 @@ def crop(image, quadrilinear):
         [0, 0], [max_width - 1, 0],
         [max_width - 1, max_height - 1],
         [0, max_height - 1]], dtype="float32")
+    return max_width, max_height, src, dst
 
+def crop(image, quadrilinear):
+    """ Crops out a quadrilinear out of the input image. """
+    max_width, max_height, src, dst = _crop_geometry(quadrilinear)
     transform = cv2.getPerspectiveTransform(src, dst)
     return cv2.warpPerspective(image, transform, (max_width, max_height))
 
+@lru_cache(maxsize=64)
+def _load_page(filename, width, height):
+    """
+        Loads the image of a document page resized to the given dimensions. Since consecutive
+        frames often show the same page, the decoded images are cached.
+    """
+    page_image = cv2.imread(filename)
+    assert page_image is not None
+    return cv2.resize(page_image, (width, height), interpolation=cv2.INTER_CUBIC)
+
 def main():
     """
         Displays the individual frames of the annotated videos along with screens
@@ -53,10 +73,7 @@ def main():
                     cv2.imshow(frame.filename, frame_image)
                     cv2.imshow("screen %d (%s)" % (screen_num, screen.condition), screen_image)
                     for keyref in screen.keyrefs:
-                        page_image = cv2.imread(keyref.page.filename)
-                        assert page_image is not None
-                        page_image = cv2.resize(page_image, (video.width, video.height),
-                                                cv2.INTER_CUBIC)
+                        page_image = _load_page(keyref.page.filename, video.width, video.height)
                         cv2.imshow("keyref (%s, %s)" % (keyref.page.filename, keyref.similarity),
                                    page_image)
                     cv2.waitKey(0)